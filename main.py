@@ -1,20 +1,61 @@
 import streamlit as st
+import contextlib
+import functools
+import hashlib
 import json
 import logging
+import os
 import re
 import uuid
 import sqlite3
+import threading
 import pandas as pd
 import io
-from datetime import datetime
-from docx import Document
-from docx.shared import Pt, RGBColor, Inches
-from openai import OpenAI
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from datetime import datetime, timedelta
+from xml.sax.saxutils import escape
+from tenacity import retry, retry_if_exception, stop_after_attempt, wait_exponential
+
+try:
+    import orjson
+except ImportError:  # orjson is optional; fall back to the stdlib parser
+    orjson = None
 
 # Configure logging
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
+# Subject options, built once at import rather than on every rerun
+SUBJECTS: tuple[str, ...] = (
+    "Mathematics 🔢", "English 🇬🇧", "History 📜", "Geography 🌍", 
+    "Biology 🌿", "Chemistry 🧪", "Physics ⚙️", 
+    "Computer Science 💻", "Music 🎵", "Art 🎨", 
+    "Sports 🏃‍♂️", "Ethics 🤔", "Religion ⛪", 
+    "Politics 🗳️", "Economics 💹", "Philosophy 🤯", 
+    "Social Studies 👥", "Psychology 🧠", "Sociology 👩‍👩‍👧‍👦", 
+    "Foreign Language 🗣️", "Latin 🏛️", 
+    "Spanish 🇪🇸", "French 🇫🇷", "Italian 🇮🇹", 
+    "Russian 🇷🇺", "Chinese 🇨🇳", "Japanese 🇯🇵", 
+    "Korean 🇰🇷", "Arabic 🇸🇦", "Media Studies 📱",
+)
+
+# Pre-compiled pattern used when repairing LLM responses (bytes-native)
+_RE_TRAIL_COMMA = re.compile(rb',\s*([}\]])')
+
+def _loads_json(content):
+    """Parse JSON text or UTF-8 bytes with orjson when available, otherwise the stdlib json"""
+    if orjson is not None:
+        return orjson.loads(content)
+    return json.loads(content)
+
+def _dumps_json(obj, pretty=False):
+    """Serialize obj to a JSON str with orjson when available, otherwise the stdlib json"""
+    if orjson is not None:
+        return orjson.dumps(obj, option=orjson.OPT_INDENT_2 if pretty else 0).decode("utf-8")
+    if pretty:
+        return json.dumps(obj, ensure_ascii=False, indent=2)
+    return json.dumps(obj, ensure_ascii=False, separators=(",", ":"))
+
 def connect_db():
     return sqlite3.connect(":memory:")  # In-memory database (temporary, resets every restart)
 
@@ -24,55 +65,180 @@ class WorksheetDatabase:
     def __init__(self, db_path='worksheets.db'):
         """Initialize database connection and create table if not exists"""
         self.db_path = db_path
+        
+        # One long-lived connection in autocommit mode; writes are serialized
+        # by the lock and grouped into explicit transactions
+        self.conn = sqlite3.connect(db_path, check_same_thread=False, isolation_level=None)
+        self._lock = threading.Lock()
+        for pragma in (
+            'PRAGMA journal_mode=WAL',
+            'PRAGMA synchronous=NORMAL',
+            'PRAGMA temp_store=MEMORY',
+            'PRAGMA mmap_size=268435456',
+            'PRAGMA cache_size=-20000',
+        ):
+            self.conn.execute(pragma)
+        
         self._create_table()
+        self._modify_worksheets_table()
+
+    @contextlib.contextmanager
+    def transaction(self):
+        """Run writes on the shared connection inside a single locked transaction"""
+        with self._lock:
+            cursor = self.conn.cursor()
+            # Take the write lock up front so the transaction can't fail midway
+            cursor.execute('BEGIN IMMEDIATE')
+            try:
+                yield cursor
+            except Exception:
+                cursor.execute('ROLLBACK')
+                raise
+            cursor.execute('COMMIT')
+
+    def connect_read_only(self):
+        """Open a separate read-only connection for ad-hoc queries that must not touch the shared one"""
+        return sqlite3.connect(f"file:{self.db_path}?mode=ro", uri=True)
 
     def _create_table(self):
         """Create worksheets table if not exists"""
-        with sqlite3.connect(self.db_path) as conn:
-            cursor = conn.cursor()
+        with self.transaction() as cursor:
             cursor.execute('''
                 CREATE TABLE IF NOT EXISTS worksheets (
                     id TEXT PRIMARY KEY,
                     subject TEXT,
                     topic TEXT,
                     worksheet_content TEXT,
-                    created_at DATETIME,
-                    user_id TEXT
+                    created_at DATETIME DEFAULT CURRENT_TIMESTAMP,
+                    user_id TEXT,
+                    content_length INTEGER
                 )
             ''')
-            conn.commit()
+            
+            # Cover both the subject-filtered and unfiltered library listings
+            cursor.execute('''
+                CREATE INDEX IF NOT EXISTS idx_worksheets_subject_created 
+                ON worksheets (subject, created_at DESC)
+            ''')
+            cursor.execute('''
+                CREATE INDEX IF NOT EXISTS idx_worksheets_created 
+                ON worksheets (created_at DESC)
+            ''')
+            cursor.execute('''
+                CREATE TABLE IF NOT EXISTS embeddings (
+                    worksheet_id TEXT PRIMARY KEY,
+                    embedding BLOB
+                )
+            ''')
+            cursor.execute('''
+                CREATE TABLE IF NOT EXISTS cache (
+                    prompt_hash TEXT PRIMARY KEY,
+                    worksheet_id TEXT,
+                    worksheet_content TEXT,
+                    created_at DATETIME DEFAULT CURRENT_TIMESTAMP
+                )
+            ''')
+
+    def _modify_worksheets_table(self):
+        """
+        Ensure worksheet_content is stored as text with comprehensive logging
+        """
+        try:
+            with self.transaction() as cursor:
+            
+                # More detailed column inspection
+                cursor.execute('''
+                    PRAGMA table_info(worksheets)
+                ''')
+                columns = cursor.fetchall()
+            
+                # Detailed logging of existing columns
+                logger.info(f"Existing columns: {columns}")
+            
+                # Check if worksheet_content column exists and is of correct type
+                worksheet_content_column = [col for col in columns if col[1] == 'worksheet_content']
+            
+                if not worksheet_content_column:
+                    # If column doesn't exist, add it with precise logging
+                    logger.warning("worksheet_content column missing. Adding column.")
+                    cursor.execute('''
+                        ALTER TABLE worksheets 
+                        ADD COLUMN worksheet_content TEXT
+                    ''')
+                    logger.info("worksheet_content column added successfully")
+                else:
+                    logger.info("worksheet_content column already exists")
+            
+                # Stored content length lets the viewer skip reading content blobs
+                if not [col for col in columns if col[1] == 'content_length']:
+                    logger.warning("content_length column missing. Adding and backfilling column.")
+                    cursor.execute('''
+                        ALTER TABLE worksheets 
+                        ADD COLUMN content_length INTEGER
+                    ''')
+                    cursor.execute('''
+                        UPDATE worksheets 
+                        SET content_length = length(worksheet_content)
+                    ''')
+                    logger.info("content_length column added successfully")
+            
+                # Cache hits point back at the worksheet they were saved as
+                cursor.execute('PRAGMA table_info(cache)')
+                if not [col for col in cursor.fetchall() if col[1] == 'worksheet_id']:
+                    logger.warning("cache.worksheet_id column missing. Adding column.")
+                    cursor.execute('''
+                        ALTER TABLE cache 
+                        ADD COLUMN worksheet_id TEXT
+                    ''')
+                    logger.info("cache.worksheet_id column added successfully")
+            
+        except Exception as e:
+            logger.error(f"Error modifying worksheets table: {e}")
+            st.error(f"Database modification error: {e}")
 
     def save_worksheet(self, subject, topic, worksheet_content, user_id=None):
         """Save a worksheet to the database"""
         worksheet_id = str(uuid.uuid4())
-        created_at = datetime.now()
+        content_json = _dumps_json(worksheet_content)  # Store as JSON string
 
-        with sqlite3.connect(self.db_path) as conn:
-            cursor = conn.cursor()
+        with self.transaction() as cursor:
             cursor.execute('''
                 INSERT INTO worksheets 
-                (id, subject, topic, worksheet_content, created_at, user_id) 
-                VALUES (?, ?, ?, ?, ?, ?)
+                (id, subject, topic, worksheet_content, created_at, user_id, content_length) 
+                VALUES (?, ?, ?, ?, CURRENT_TIMESTAMP, ?, ?)
             ''', (
                 worksheet_id, 
                 subject, 
                 topic, 
-                json.dumps(worksheet_content),  # Store as JSON string
-                created_at, 
-                user_id
+                content_json, 
+                user_id,
+                len(content_json)
             ))
-            conn.commit()
         
         return worksheet_id
 
+    def update_worksheet(self, worksheet_id, subject, worksheet_content):
+        """Update a worksheet's subject and content; returns False if the ID doesn't exist"""
+        content_json = _dumps_json(worksheet_content)
+
+        with self.transaction() as cursor:
+            cursor.execute('''
+                UPDATE worksheets 
+                SET worksheet_content = ?, 
+                    subject = ?, 
+                    content_length = ? 
+                WHERE id = ?
+            ''', (content_json, subject, len(content_json), worksheet_id))
+            return cursor.rowcount > 0
+
     def get_worksheet_by_id(self, worksheet_id):
         """Retrieve a specific worksheet by its ID"""
-        with sqlite3.connect(self.db_path) as conn:
-            cursor = conn.cursor()
-            cursor.execute('''
-                SELECT * FROM worksheets WHERE id = ?
-            ''', (worksheet_id,))
-            result = cursor.fetchone()
+        cursor = self.conn.cursor()
+        cursor.execute('''
+            SELECT id, subject, topic, worksheet_content, created_at, user_id 
+            FROM worksheets WHERE id = ?
+        ''', (worksheet_id,))
+        result = cursor.fetchone()
         
         if result:
             # Unpack the result
@@ -81,7 +247,7 @@ class WorksheetDatabase:
                 'id': id,
                 'subject': subject,
                 'topic': topic,
-                'worksheet_content': json.loads(worksheet_content),
+                'worksheet_content': _loads_json(worksheet_content),
                 'created_at': created_at,
                 'user_id': user_id
             }
@@ -89,177 +255,481 @@ class WorksheetDatabase:
 
     def list_worksheets(self, subject=None, limit=10):
         """List worksheets, optionally filtered by subject"""
-        with sqlite3.connect(self.db_path) as conn:
-            cursor = conn.cursor()
-            if subject:
-                cursor.execute('''
-                    SELECT id, subject, topic, created_at 
-                    FROM worksheets 
-                    WHERE subject = ? 
-                    ORDER BY created_at DESC 
-                    LIMIT ?
-                ''', (subject, limit))
-            else:
-                cursor.execute('''
-                    SELECT id, subject, topic, created_at 
-                    FROM worksheets 
-                    ORDER BY created_at DESC 
-                    LIMIT ?
-                ''', (limit,))
+        cursor = self.conn.cursor()
+        if subject:
+            cursor.execute('''
+                SELECT id, subject, topic, created_at 
+                FROM worksheets 
+                WHERE subject = ? 
+                ORDER BY created_at DESC 
+                LIMIT ?
+            ''', (subject, limit))
+        else:
+            cursor.execute('''
+                SELECT id, subject, topic, created_at 
+                FROM worksheets 
+                ORDER BY created_at DESC 
+                LIMIT ?
+            ''', (limit,))
             
-            return cursor.fetchall()
+        return cursor.fetchall()
 
-# Initialize database
-worksheet_db = WorksheetDatabase()
+    def get_worksheet_contents(self, worksheet_ids):
+        """Retrieve the content of several worksheets in one query, keyed by ID"""
+        if not worksheet_ids:
+            return {}
+
+        cursor = self.conn.cursor()
+        placeholders = ', '.join('?' * len(worksheet_ids))
+        cursor.execute(f'''
+            SELECT id, worksheet_content FROM worksheets WHERE id IN ({placeholders})
+        ''', tuple(worksheet_ids))
+
+        return {id: _loads_json(worksheet_content) for id, worksheet_content in cursor.fetchall()}
+
+    def get_cached_worksheet(self, prompt_hash, max_age=None):
+        """
+        Return (worksheet_id, worksheet) for a cached prompt hash, or None if
+        missing or stale. worksheet_id is None when the saved worksheet is gone.
+        """
+        # Compare on SQLite's UTC clock, the same one that stamps created_at
+        age_modifier = f"-{int((max_age or CACHE_TTL).total_seconds())} seconds"
+
+        cursor = self.conn.cursor()
+        cursor.execute('''
+            SELECT w.id, c.worksheet_content FROM cache c 
+            LEFT JOIN worksheets w ON w.id = c.worksheet_id 
+            WHERE c.prompt_hash = ? AND c.created_at > datetime('now', ?)
+        ''', (prompt_hash, age_modifier))
+        result = cursor.fetchone()
+
+        if result:
+            return result[0], _loads_json(result[1])
+        return None
+
+    def cache_worksheet(self, prompt_hash, worksheet_id, worksheet_content):
+        """Store a generated worksheet, and the ID it was saved under, in the response cache"""
+        with self.transaction() as cursor:
+            cursor.execute('''
+                INSERT OR REPLACE INTO cache 
+                (prompt_hash, worksheet_id, worksheet_content, created_at) 
+                VALUES (?, ?, ?, CURRENT_TIMESTAMP)
+            ''', (prompt_hash, worksheet_id, _dumps_json(worksheet_content)))
 
-# Clean JSON Content
-def clean_json_content(raw_content):
+    def list_embeddings(self):
+        """List every worksheet's subject and topic with its stored embedding, if any"""
+        cursor = self.conn.cursor()
+        cursor.execute('''
+            SELECT w.id, w.subject, w.topic, e.embedding 
+            FROM worksheets w 
+            LEFT JOIN embeddings e ON e.worksheet_id = w.id
+        ''')
+        return cursor.fetchall()
+
+    def save_embeddings(self, rows):
+        """Store (worksheet_id, embedding bytes) pairs"""
+        with self.transaction() as cursor:
+            cursor.executemany('''
+                INSERT OR REPLACE INTO embeddings (worksheet_id, embedding) 
+                VALUES (?, ?)
+            ''', rows)
+
+# How long cached LLM responses are reused before regenerating
+CACHE_TTL = timedelta(days=7)
+
+# Semantic cache settings
+EMBEDDING_MODEL = "all-MiniLM-L6-v2"
+SEMANTIC_CACHE_THRESHOLD = 0.92
+
+class SemanticCache:
     """
-    Comprehensively clean and prepare JSON content for parsing.
-    Extremely robust method to extract a valid JSON object.
+    Nearest-neighbour lookup of earlier worksheets by the meaning of their
+    subject and topic, using sentence-transformer embeddings in a FAISS index
     """
-    import re
-    import json
+    def __init__(self, db, threshold=SEMANTIC_CACHE_THRESHOLD):
+        """Load the embedding model and index every stored worksheet"""
+        import faiss
+        import numpy as np
+        from sentence_transformers import SentenceTransformer
 
-    # Convert to string
-    raw_content = str(raw_content)
+        self.db = db
+        self.threshold = threshold
+        self._np = np
+        self._model = SentenceTransformer(EMBEDDING_MODEL)
+        self._index = faiss.IndexFlatIP(self._model.get_sentence_embedding_dimension())
+        self._ids = []
+        self._lock = threading.Lock()
+        self._load()
 
-    # Try multiple strategies to extract JSON
-    def extract_json_strategies():
-        strategies = [
-            # Strategy 1: Regex to find JSON object with worksheet key
-            lambda x: re.search(r'\{[^}]*"worksheet"\s*:\s*\[[^\]]+\][^}]*\}', x),
-            
-            # Strategy 2: Find between first { and last }
-            lambda x: re.search(r'\{.*\}', x, re.DOTALL),
-            
-            # Strategy 3: Extract everything between first { and last }
-            lambda x: x[x.find('{'):x.rfind('}')+1],
-        ]
+    def _embed(self, texts):
+        """Encode texts as normalized float32 vectors so inner product is cosine"""
+        vectors = self._model.encode(texts, normalize_embeddings=True)
+        return self._np.asarray(vectors, dtype='float32')
 
-        for strategy in strategies:
-            try:
-                match = strategy(raw_content)
-                if match:
-                    # If it's a regex match, get the matched group
-                    cleaned = match.group(0) if hasattr(match, 'group') else match
-                    
-                    # Additional cleaning
-                    cleaned = re.sub(r',\s*}', '}', cleaned)  # Remove trailing commas
-                    cleaned = re.sub(r'{\s*"', '{"', cleaned)  # Ensure proper key start
-                    cleaned = cleaned.strip()
+    def _load(self):
+        """Build the index from stored embeddings, embedding any rows that lack one"""
+        rows = self.db.list_embeddings()
+        missing = [row for row in rows if row[3] is None]
 
-                    # Validate JSON structure
-                    parsed = json.loads(cleaned)
-                    
-                    # Ensure worksheet key exists and has 9 elements
-                    if (
-                        "worksheet" in parsed and 
-                        isinstance(parsed["worksheet"], list) and 
-                        len(parsed["worksheet"]) == 9 and
-                        all(isinstance(item, str) and item.strip() for item in parsed["worksheet"])
-                    ):
-                        return cleaned
-            except (json.JSONDecodeError, Exception) as e:
-                # Log or print the specific error if needed
-                logger.warning(f"JSON extraction strategy failed: {e}")
-        
+        if missing:
+            vectors = self._embed([f"{subject} {topic}" for _, subject, topic, _ in missing])
+            self.db.save_embeddings([
+                (row[0], vector.tobytes()) for row, vector in zip(missing, vectors)
+            ])
+            missing_vectors = dict(zip((row[0] for row in missing), vectors))
+
+        for worksheet_id, _, _, blob in rows:
+            if blob is None:
+                vector = missing_vectors[worksheet_id]
+            else:
+                vector = self._np.frombuffer(blob, dtype='float32')
+            self._index.add(vector.reshape(1, -1))
+            self._ids.append(worksheet_id)
+
+    def lookup(self, subject, topic):
+        """Return (worksheet_id, worksheet) of the closest earlier worksheet, or None below the threshold"""
+        vector = self._embed([f"{subject} {topic}"])
+
+        with self._lock:
+            if not self._ids:
+                return None
+            scores, positions = self._index.search(vector, 1)
+            worksheet_id = self._ids[positions[0][0]]
+
+        if scores[0][0] < self.threshold:
+            return None
+
+        logger.info(f"Semantic cache hit for {subject} - {topic} (score {scores[0][0]:.3f})")
+        worksheet = self.db.get_worksheet_by_id(worksheet_id)
+        return (worksheet_id, worksheet['worksheet_content']) if worksheet else None
+
+    def add(self, worksheet_id, subject, topic):
+        """Index and persist the embedding of a newly generated worksheet"""
+        vector = self._embed([f"{subject} {topic}"])
+        self.db.save_embeddings([(worksheet_id, vector[0].tobytes())])
+
+        with self._lock:
+            self._index.add(vector)
+            self._ids.append(worksheet_id)
+
+@st.cache_resource
+def get_semantic_cache():
+    """
+    Build the semantic cache once per process. Returns None when the optional
+    faiss-cpu / sentence-transformers dependencies are not installed or the
+    embedding model can't be loaded.
+    """
+    try:
+        return SemanticCache(get_worksheet_db())
+    except ImportError as e:
+        logger.info(f"Semantic cache disabled: {e}")
+        return None
+    except Exception as e:
+        # e.g. no network or disk space to download the embedding model
+        logger.warning(f"Semantic cache disabled, failed to load: {e}")
         return None
 
-    # Try to extract JSON
-    cleaned_json = extract_json_strategies()
+@st.cache_resource
+def get_worksheet_db():
+    """Share one database connection across Streamlit reruns and sessions"""
+    return WorksheetDatabase()
+
+# Initialize database
+worksheet_db = get_worksheet_db()
+
+@st.cache_data(ttl=30)
+def _cached_list_worksheets(subject, limit):
+    """List worksheets without re-querying SQLite on every widget event; cleared after writes"""
+    return worksheet_db.list_worksheets(subject=subject, limit=limit)
+
+def _is_valid_worksheet(parsed):
+    """Check that parsed JSON has a 'worksheet' list of 9 non-empty strings"""
+    return (
+        isinstance(parsed, dict) and
+        "worksheet" in parsed and 
+        isinstance(parsed["worksheet"], list) and 
+        len(parsed["worksheet"]) == 9 and
+        all(isinstance(item, str) and item.strip() for item in parsed["worksheet"])
+    )
+
+def _looks_like_worksheet(content):
+    """
+    Cheap structural pre-check on JSON bytes before a full parse: a valid
+    worksheet needs the key, 9 quoted strings (20 quotes) and 8 separators
+    """
+    return (
+        b'"worksheet"' in content and
+        content.count(b'"') >= 20 and
+        content.count(b',') >= 8
+    )
+
+def _decode_worksheet_object(raw_content):
+    """
+    Decode the object that holds the "worksheet" key, ignoring any stray
+    {...} chatter before or after it. Trailing commas are only repaired
+    when the object doesn't decode as-is.
+    """
+    decoder = json.JSONDecoder()
+    variants = [raw_content]
+    if b',' in raw_content:
+        variants.append(_RE_TRAIL_COMMA.sub(rb'\1', raw_content))
+
+    for variant in variants:
+        text = variant.decode("utf-8", "replace")
+        key = text.find('"worksheet"')
+        while key != -1:
+            start = text.rfind('{', 0, key)
+            if start != -1:
+                try:
+                    # raw_decode stops at the end of the object
+                    parsed, _ = decoder.raw_decode(text, start)
+                    if _is_valid_worksheet(parsed):
+                        return parsed
+                except ValueError:
+                    pass
+            key = text.find('"worksheet"', key + 1)
+
+    raise ValueError("Unable to extract valid JSON object")
+
+# Parse Worksheet Content
+def parse_worksheet_content(raw_content):
+    """
+    Extract and validate the worksheet from a raw LLM response with a single parse.
+    Works on UTF-8 bytes and returns the list of 9 worksheet strings.
+    """
+    # Convert to bytes
+    if isinstance(raw_content, (bytes, bytearray)):
+        raw_content = bytes(raw_content)
+    else:
+        raw_content = str(raw_content).encode("utf-8")
+
+    # Everything between the first { and the last } also drops any code
+    # fences or chatter around the object
+    start = raw_content.find(b'{')
+    end = raw_content.rfind(b'}')
+    if start == -1 or end < start:
+        raise ValueError("Unable to extract valid JSON object")
+    candidate = raw_content[start:end + 1]
+
+    # Structurally impossible responses skip the parse entirely
+    if not _looks_like_worksheet(candidate):
+        raise ValueError("Response cannot contain a 9-item worksheet")
+
+    # Fast path: the slice is usually exactly the worksheet object
+    try:
+        parsed = _loads_json(candidate)
+    except ValueError as e:
+        logger.warning(f"JSON parse failed, decoding from the worksheet key instead: {e}")
+        parsed = _decode_worksheet_object(raw_content)
+
+    # Ensure worksheet key exists and has 9 elements
+    if not _is_valid_worksheet(parsed):
+        raise ValueError("JSON object does not contain a valid 9-item worksheet")
+
+    return parsed["worksheet"]
+
+# LLM settings shared by every generation request
+MODEL = "deepseek/deepseek-r1-zero:free"
+SYSTEM_PROMPT = "VERY IMPORTANT: Respond ONLY with a SINGLE, VALID JSON object. The object MUST have a 'worksheet' key with EXACTLY 9 string elements. NO additional text before or after the JSON. Ensure each element is a non-empty string."
+
+def _prompt_hash(subject, topic):
+    """Key identifying a worksheet request in the response cache"""
+    return hashlib.sha256(f"{subject}|{topic}|{MODEL}".encode("utf-8")).hexdigest()
+
+def _chat_messages(prompt_text):
+    """Build the chat messages sent for a worksheet prompt"""
+    return [
+        {"role": "system", "content": SYSTEM_PROMPT},
+        {"role": "user", "content": prompt_text},
+    ]
+
+OPENAI_API_KEY = os.getenv("OPENROUTER_API_KEY")  # Load from Vercel
+
+@st.cache_resource
+def _client():
+    """
+    Create the OpenRouter client once per process so its connection pool
+    survives Streamlit reruns
+    """
+    import httpx
+    from openai import OpenAI
+
+    return OpenAI(
+        base_url="https://openrouter.ai/api/v1",
+        api_key=OPENAI_API_KEY,
+        max_retries=0,  # Retries are handled by _open_completion_stream
+        # HTTP/2 multiplexes concurrent generations over one kept-alive connection
+        http_client=httpx.Client(http2=True, limits=httpx.Limits(max_keepalive_connections=10))
+    )
+
+def _is_transient_api_error(exc):
+    """Rate limits, timeouts, connection failures and 5xx errors are worth retrying after a pause"""
+    import openai
+
+    # APIConnectionError also covers APITimeoutError
+    return isinstance(exc, (openai.RateLimitError, openai.APIConnectionError, openai.InternalServerError))
+
+_exponential_wait = wait_exponential(multiplier=1, min=1, max=10)
+
+def _wait_for_retry(retry_state):
+    """Honor the server's retry-after header, otherwise back off exponentially"""
+    response = getattr(retry_state.outcome.exception(), "response", None)
+    if response is not None:
+        try:
+            return max(0.0, min(float(response.headers.get("retry-after")), 60))
+        except (TypeError, ValueError):
+            pass
+    return _exponential_wait(retry_state)
+
+@retry(
+    stop=stop_after_attempt(3),
+    wait=_wait_for_retry,
+    retry=retry_if_exception(_is_transient_api_error),
+    reraise=True
+)
+def _open_completion_stream(client, prompt_text):
+    """Start a streamed worksheet completion, backing off on transient API errors"""
+    return client.chat.completions.create(
+        model=MODEL,
+        response_format={"type": "json_object"},
+        messages=_chat_messages(prompt_text),
+        stream=True
+    )
+
+def _llm_json(client, prompt_text, cancelled=None):
+    """
+    Send a prompt to the LLM and return the worksheet as a tuple of strings.
+    Returns None without finishing the stream once `cancelled` is set.
+    Repeat prompts are served by the SQLite response cache before this runs.
+    """
+    if cancelled is not None and cancelled.is_set():
+        return None
     
-    if cleaned_json:
-        return cleaned_json
+    stream = _open_completion_stream(client, prompt_text)
     
-    # Last resort: raise an error
-    raise ValueError("Unable to extract valid JSON object")
+    # Accumulate streamed deltas as they arrive instead of waiting for the
+    # full completion object
+    buffer = bytearray()
+    with contextlib.closing(stream):
+        for chunk in stream:
+            if cancelled is not None and cancelled.is_set():
+                # Another attempt already won; closing the stream stops the generation
+                return None
+            if chunk.choices and chunk.choices[0].delta.content:
+                buffer += chunk.choices[0].delta.content.encode("utf-8")
+    
+    raw_content = bytes(buffer)
+    logger.info(f"Raw response content: {raw_content.decode('utf-8', 'replace')}")
+    
+    try:
+        worksheet = parse_worksheet_content(raw_content)
+    except ValueError:
+        logger.error(f"Problematic content: {raw_content.decode('utf-8', 'replace')}")
+        raise
+    
+    return tuple(worksheet)
+
+# Seconds an attempt may run before a second one is started alongside it
+HEDGE_DELAY = 20
 
 def response(prompt_text, max_retries=3):
     progress_bar = st.progress(0)
     status_text = st.empty()
 
-    for attempt in range(max_retries):
-        try:
-            status_text.info(f"Generating worksheet (Attempt {attempt + 1}/{max_retries})...")
-            progress_bar.progress(min((attempt + 1) * 25, 75))
-            
-            logger.info(f"Attempt {attempt + 1}: Sending prompt")
-            
-            response = client.chat.completions.create(
-                model="deepseek/deepseek-r1-zero:free",
-                response_format={"type": "json_object"},
-                messages=[
-                    {
-                        "role": "system", 
-                        "content": "VERY IMPORTANT: Respond ONLY with a SINGLE, VALID JSON object. The object MUST have a 'worksheet' key with EXACTLY 9 string elements. NO additional text before or after the JSON. Ensure each element is a non-empty string."
-                    },
-                    {"role": "user", "content": prompt_text},
-                ]
+    status_text.info("Generating worksheet...")
+    progress_bar.progress(25)
+    logger.info(f"Sending prompt with up to {max_retries} attempts")
+
+    client = _client()
+
+    # Start one attempt and only add another when an attempt fails or runs
+    # past HEDGE_DELAY; the first valid worksheet wins and the rest are cancelled
+    cancelled = threading.Event()
+    executor = ThreadPoolExecutor(max_workers=max_retries)
+    pending = {executor.submit(_llm_json, client, prompt_text, cancelled)}
+    launched = 1
+    attempt = 0
+
+    try:
+        while pending:
+            done, pending = wait(
+                pending,
+                timeout=HEDGE_DELAY if launched < max_retries else None,
+                return_when=FIRST_COMPLETED
             )
+            if not done:
+                logger.info(f"Attempt still running after {HEDGE_DELAY}s, starting another")
+                pending.add(executor.submit(_llm_json, client, prompt_text, cancelled))
+                launched += 1
+                continue
             
-            raw_content = response.choices[0].message.content
-            logger.info(f"Raw response content: {raw_content}")
-            
-            status_text.info("Cleaning and parsing response...")
-            progress_bar.progress(min((attempt + 1) * 40, 90))
-            
-            # Comprehensive cleaning
-            cleaned_content = clean_json_content(raw_content)
-            logger.info(f"Cleaned content: {cleaned_content}")
-            
-            # Parse cleaned content
-            worksheet_data = json.loads(cleaned_content)
-            
-            progress_bar.progress(100)
-            status_text.success("Worksheet generated successfully!")
-            
-            # Delay and clear progress indicators
-            import time
-            time.sleep(1)
-            progress_bar.empty()
-            status_text.empty()
-            
-            return worksheet_data["worksheet"]
-            
-        except (json.JSONDecodeError, ValueError) as e:
-            logger.error(f"JSON Parsing Error: {e}")
-            status_text.error(f"JSON Parsing Error on Attempt {attempt + 1}")
-            logger.error(f"Problematic content: {raw_content}")
-            
-            # Additional logging to help diagnose the issue
-            try:
-                import traceback
-                logger.error(f"Traceback: {traceback.format_exc()}")
-            except Exception:
-                pass
-        
-        except Exception as e:
-            logger.error(f"Unexpected Error: {e}")
-            status_text.error(f"Unexpected Error on Attempt {attempt + 1}")
-            
-            # Additional logging
-            try:
-                import traceback
-                logger.error(f"Full Traceback: {traceback.format_exc()}")
-            except Exception:
-                pass
+            for future in done:
+                attempt += 1
+                try:
+                    worksheet = future.result()
+                    
+                    # The toast dismisses itself, so the placeholders can go right away
+                    progress_bar.empty()
+                    status_text.empty()
+                    st.toast("Worksheet generated!", icon="✅")
+                    
+                    return list(worksheet)
+                    
+                except (json.JSONDecodeError, ValueError) as e:
+                    logger.error(f"JSON Parsing Error: {e}")
+                    status_text.error(f"JSON Parsing Error on Attempt {attempt}")
+                    
+                    # Additional logging to help diagnose the issue
+                    try:
+                        import traceback
+                        logger.error(f"Traceback: {traceback.format_exc()}")
+                    except Exception:
+                        pass
+                
+                except Exception as e:
+                    logger.error(f"Unexpected Error: {e}")
+                    status_text.error(f"Unexpected Error on Attempt {attempt}")
+                    
+                    # Additional logging
+                    try:
+                        import traceback
+                        logger.error(f"Full Traceback: {traceback.format_exc()}")
+                    except Exception:
+                        pass
+                
+                progress_bar.progress(min(25 + attempt * 25, 90))
+                
+                # Replace the failed attempt while retries remain
+                if launched < max_retries:
+                    pending.add(executor.submit(_llm_json, client, prompt_text, cancelled))
+                    launched += 1
+    finally:
+        # Stop any attempts still streaming and don't wait for them
+        cancelled.set()
+        executor.shutdown(wait=False, cancel_futures=True)
         
     progress_bar.empty()
     st.error("Failed to generate worksheet after maximum retries. Please try again.")
     return None
-import os
-
-OPENAI_API_KEY = os.getenv("OPENROUTER_API_KEY")  # Load from Vercel
-
-client = OpenAI(
-    base_url="https://openrouter.ai/api/v1",
-    api_key=OPENAI_API_KEY
-)
-
 
 # Prompt Generation
+@functools.lru_cache(maxsize=512)
 def prompt(subject, topic):
+    # Serializing the example keeps quotes in subject/topic from breaking the JSON
+    example = _dumps_json({
+        "worksheet": [
+            f"{subject} Worksheet: {topic}",
+            f"Define the primary concept of {topic}",
+            f"Explain the significance of a key aspect in {topic}",
+            "Analyze the relationship between two core ideas",
+            "Describe the main characteristics of the subject",
+            "Compare and contrast different perspectives",
+            "Multiple choice: Which statement best describes...",
+            "Multiple choice: Select the correct explanation for...",
+            f"Complete the passage about {topic} by filling in the blanks...",
+        ]
+    }, pretty=True)
+
     return f"""Generate a worksheet JSON for {subject} on {topic}:
 
 REQUIREMENTS:
@@ -271,96 +741,176 @@ REQUIREMENTS:
 - Last element: Cloze passage
 
 EXAMPLE FORMAT:
-{{
-    "worksheet": [
-        "{subject} Worksheet: {topic}",
-        "Define the primary concept of {topic}",
-        "Explain the significance of a key aspect in {topic}",
-        "Analyze the relationship between two core ideas",
-        "Describe the main characteristics of the subject",
-        "Compare and contrast different perspectives",
-        "Multiple choice: Which statement best describes...",
-        "Multiple choice: Select the correct explanation for...",
-        "Complete the passage about {topic} by filling in the blanks..."
-    ]
-}}
+{example}
 
 Be specific, educational, and ensure clear, engaging questions."""
 
+@functools.cache
+def _docx():
+    """
+    Import python-docx on first use so app startup doesn't pay for it
+    """
+    from docx import Document
+    from docx.enum.style import WD_STYLE_TYPE
+    from docx.oxml import parse_xml
+    from docx.shared import Pt, Inches
+
+    return Document, parse_xml, Pt, Inches, WD_STYLE_TYPE
+
+_W_NS = 'xmlns:w="http://schemas.openxmlformats.org/wordprocessingml/2006/main"'
+
+# Raw XML for a question paragraph; formatting comes from the template's "Q" style
+_QUESTION_P = (
+    f'<w:p {_W_NS}><w:pPr><w:pStyle w:val="Q"/></w:pPr>'
+    '<w:r>{run}</w:r></w:p>'
+)
+# Tabs and line breaks become their own run elements, as python-docx's run.text does
+_RE_RUN_BREAKS = re.compile(r'([\t\r\n])')
+_RUN_BREAKS = {'\t': '<w:tab/>', '\r': '<w:br/>', '\n': '<w:br/>'}
+# Raw XML for a blank spacer paragraph
+_EMPTY_P = f'<w:p {_W_NS}/>'
+
+def _run_xml(text):
+    """Build the XML content of a run, keeping tabs and line breaks in the text"""
+    return ''.join(
+        _RUN_BREAKS.get(piece) or f'<w:t xml:space="preserve">{escape(piece)}</w:t>'
+        for piece in _RE_RUN_BREAKS.split(text)
+        if piece
+    )
+
+def _append_paragraph_xml(body, paragraph_xml):
+    """Append a raw <w:p> element to the document body, ahead of its section properties"""
+    _, parse_xml, _, _, _ = _docx()
+    paragraph = parse_xml(paragraph_xml)
+    if body.sectPr is not None:
+        body.sectPr.addprevious(paragraph)
+    else:
+        body.append(paragraph)
+
+@functools.lru_cache(maxsize=1)
+def _template_bytes():
+    """
+    Build the empty, pre-styled worksheet document once and return it serialized
+    """
+    Document, _, Pt, Inches, WD_STYLE_TYPE = _docx()
+    doc = Document()
+    
+    # Consistent section margins
+    sections = doc.sections
+    for section in sections:
+        section.left_margin = Inches(0.75)
+        section.right_margin = Inches(0.75)
+        section.top_margin = Inches(1)
+        section.bottom_margin = Inches(1)
+
+    # Styling
+    style = doc.styles['Normal']
+    font = style.font
+    font.name = 'Calibri'
+    font.size = Pt(12)
+    
+    # Bold 14pt question style, defined once instead of formatting every run
+    q_style = doc.styles.add_style('Q', WD_STYLE_TYPE.PARAGRAPH)
+    q_style.base_style = style
+    q_style.font.name = 'Calibri'
+    q_style.font.size = Pt(14)
+    q_style.font.bold = True
+    
+    bio = io.BytesIO()
+    doc.save(bio)
+    return bio.getvalue()
+
+@functools.lru_cache(maxsize=256)
+def _word_bytes(subject, worksheet, date):
+    """
+    Build the worksheet document and return it serialized.
+    Memoized on (subject, worksheet tuple, header date) so unchanged
+    worksheets are not rebuilt on every rerun.
+    """
+    Document, _, Pt, _, _ = _docx()
+
+    # Start from the cached template with margins and styles already set
+    doc = Document(io.BytesIO(_template_bytes()))
+    
+    # Add header
+    section = doc.sections[0]
+    header = section.header
+    header.is_linked_to_previous = False
+    header_paragraph = header.paragraphs[0]
+    header_paragraph.text = f"{subject}\t\t{date}"
+    
+    # Main title
+    title_paragraph = doc.add_paragraph()
+    title_run = title_paragraph.add_run(worksheet[0])
+    title_font = title_run.font
+    title_font.bold = True
+    title_font.size = Pt(18)
+    title_font.name = 'Calibri'
+
+    # Add some spacing
+    body = doc.element.body
+    _append_paragraph_xml(body, _EMPTY_P)
+
+    # Questions, built as raw XML to skip python-docx's run/font plumbing
+    for i, content in enumerate(worksheet[1:], start=1):
+        _append_paragraph_xml(body, _QUESTION_P.format(run=_run_xml(f"{i}) {content}")))
+        
+        # Add answer space
+        _append_paragraph_xml(body, _EMPTY_P)  # Blank line for answers
+    
+    # Save to BytesIO instead of file system
+    bio = io.BytesIO()
+    doc.save(bio)
+    
+    return bio.getvalue()
+
+def _header_date():
+    """Today's date as shown in the worksheet header"""
+    return datetime.now().strftime("%d.%m.%y")
+
 def word(worksheet, subject):
     """
     Generate a Word document in memory without file system storage
     """
     try:
-        doc = Document()
-        
-        # Consistent section margins
-        sections = doc.sections
-        for section in sections:
-            section.left_margin = Inches(0.75)
-            section.right_margin = Inches(0.75)
-            section.top_margin = Inches(1)
-            section.bottom_margin = Inches(1)
-
-        # Styling
-        style = doc.styles['Normal']
-        font = style.font
-        font.name = 'Calibri'
-        font.size = Pt(12)
-        
-        # Header
-        current_date = datetime.now()
-        date = current_date.strftime("%d.%m.%y")
-        
-        # Add header
-        section = doc.sections[0]
-        header = section.header
-        header.is_linked_to_previous = False
-        header_paragraph = header.paragraphs[0]
-        header_paragraph.text = f"{subject}\t\t{date}"
-        
-        # Main title
-        title_paragraph = doc.add_paragraph()
-        title_run = title_paragraph.add_run(worksheet[0])
-        title_run.bold = True
-        title_run.font.size = Pt(18)
-        title_run.font.name = 'Calibri'
-
-        # Add some spacing
-        doc.add_paragraph()
-
-        # Questions
-        for i, content in enumerate(worksheet[1:], start=1):
-            question_paragraph = doc.add_paragraph(f"{i}) {content}")
-            question_run = question_paragraph.runs[0]
-            question_run.font.bold = True
-            question_run.font.size = Pt(14)
-            
-            # Add answer space
-            doc.add_paragraph()  # Blank line for answers
-        
-        # Save to BytesIO instead of file system
-        bio = io.BytesIO()
-        doc.save(bio)
-        bio.seek(0)
-        
-        return bio
+        # Header date is part of the cache key so documents roll over daily
+        return io.BytesIO(_word_bytes(subject, tuple(worksheet), _header_date()))
     
     except Exception as e:
         st.error(f"Error generating Word document: {e}")
         return None
 
 def create_worksheet(subject_selection, topic):
-    # Generate initial worksheet
-    worksheet = response(prompt(subject_selection, topic))
+    # Reuse a recent generation for the same request before calling the LLM
+    prompt_hash = _prompt_hash(subject_selection, topic)
+    cached = worksheet_db.get_cached_worksheet(prompt_hash)
+    
+    # Fall back to a worksheet for a near-identical request
+    semantic_cache = get_semantic_cache()
+    if cached is None and semantic_cache is not None:
+        cached = semantic_cache.lookup(subject_selection, topic)
+    
+    worksheet_id, worksheet = cached or (None, None)
+    generated = False
+    if worksheet is None:
+        # Generate initial worksheet
+        worksheet = response(prompt(subject_selection, topic))
+        generated = bool(worksheet)
     
     if worksheet:
-        # Save worksheet to database
-        worksheet_id = worksheet_db.save_worksheet(
-            subject=subject_selection, 
-            topic=topic, 
-            worksheet_content=worksheet
-        )
+        # Cache hits reuse the worksheet they were saved as; only new content
+        # (or a cache entry whose worksheet is gone) adds a library row
+        if worksheet_id is None:
+            worksheet_id = worksheet_db.save_worksheet(
+                subject=subject_selection, 
+                topic=topic, 
+                worksheet_content=worksheet
+            )
+            worksheet_db.cache_worksheet(prompt_hash, worksheet_id, worksheet)
+            _cached_list_worksheets.clear()
+        
+        if generated and semantic_cache is not None:
+            semantic_cache.add(worksheet_id, subject_selection, topic)
         
         # Create Word document in memory
         doc_download = word(worksheet, subject_selection)
@@ -395,14 +945,11 @@ def save_worksheet_changes(worksheet_id, subject, edited_worksheet):
     Save worksheet changes to the database
     """
     try:
-        with sqlite3.connect('worksheets.db') as conn:
-            cursor = conn.cursor()
-            cursor.execute('''
-                UPDATE worksheets 
-                SET worksheet_content = ? 
-                WHERE id = ?
-            ''', (json.dumps(edited_worksheet), worksheet_id))
-            conn.commit()
+        # No matched row means the ID doesn't exist
+        if not worksheet_db.update_worksheet(worksheet_id, subject, edited_worksheet):
+            st.error(f"No worksheet found with ID: {worksheet_id}")
+            return None
+        _cached_list_worksheets.clear()
         
         # Generate updated Word document in memory
         updated_doc = word(edited_worksheet, subject)
@@ -412,99 +959,6 @@ def save_worksheet_changes(worksheet_id, subject, edited_worksheet):
         st.error(f"Error saving worksheet: {e}")
         return None
 
-def worksheet_library_page():
-    st.header("Worksheet Library")
-    
-    # Filter options
-    filter_subject = st.selectbox(
-        "Filter by Subject", 
-        ["All Subjects"] + [
-            "Mathematics", "English", "History", "Geography", 
-            "Biology", "Chemistry", "Physics", "Computer Science"
-        ]
-    )
-    
-    # Retrieve worksheets
-    if filter_subject == "All Subjects":
-        worksheets = worksheet_db.list_worksheets(limit=20)
-    else:
-        worksheets = worksheet_db.list_worksheets(subject=filter_subject, limit=20)
-    
-    # Display worksheets
-    for idx, worksheet in enumerate(worksheets):
-        worksheet_id, subject, topic, created_at = worksheet
-        
-        with st.expander(f"{subject} - {topic} (Created: {created_at})"):
-            # Retrieve full worksheet details
-            full_worksheet = worksheet_db.get_worksheet_by_id(worksheet_id)
-            
-            # Display worksheet content
-            for i, item in enumerate(full_worksheet['worksheet_content'], 1):
-                st.write(f"{i}. {item}")
-            
-            # Generate Word document in memory
-            doc_bytes = word(full_worksheet['worksheet_content'], subject)
-            
-            if doc_bytes:
-                # Download button with unique key
-                st.download_button(
-                    label="Download Worksheet",
-                    data=doc_bytes,
-                    file_name=f"{subject}_{topic}_worksheet.docx",
-                    mime="application/vnd.openxmlformats-officedocument.wordprocessingml.document",
-                    key=f"download_library_{idx}"
-                )
-            else:
-                st.error(f"Failed to generate Word document for {subject} - {topic}")
-    """
-    Save worksheet changes to the database with comprehensive error handling
-    """
-    try:
-        # Validate input
-        if not worksheet_id or not subject or not edited_worksheet:
-            st.error("Invalid input: Missing worksheet details")
-            return None
-
-        with sqlite3.connect('worksheets.db') as conn:
-            cursor = conn.cursor()
-            
-            # Check if worksheet exists
-            cursor.execute('SELECT * FROM worksheets WHERE id = ?', (worksheet_id,))
-            existing_worksheet = cursor.fetchone()
-            
-            if not existing_worksheet:
-                st.error(f"No worksheet found with ID: {worksheet_id}")
-                return None
-
-            # Update worksheet content
-            cursor.execute('''
-                UPDATE worksheets 
-                SET worksheet_content = ?, 
-                    subject = ?
-                WHERE id = ?
-            ''', (json.dumps(edited_worksheet), subject, worksheet_id))
-            
-            # Ensure changes are committed
-            conn.commit()
-        
-        # Generate updated Word document
-        doc_download = word(edited_worksheet, subject)
-        
-        if doc_download:
-            st.success("Worksheet updated successfully!")
-            return doc_download
-        else:
-            st.error("Failed to generate updated Word document")
-            return None
-    
-    except sqlite3.Error as e:
-        st.error(f"Database error: {e}")
-        logger.error(f"Database error in save_worksheet_changes: {e}")
-    except Exception as e:
-        st.error(f"Unexpected error saving worksheet: {e}")
-        logger.error(f"Unexpected error in save_worksheet_changes: {e}")
-    
-    return None
 def edit_worksheet(worksheet_id, subject, worksheet_content):
     """
     Create a comprehensive editable view of the worksheet with versioning
@@ -532,27 +986,13 @@ def edit_worksheet(worksheet_id, subject, worksheet_content):
         # Handle saving changes
         if save_changes:
             try:
-                # Generate a new unique ID for the edited worksheet
-                new_worksheet_id = str(uuid.uuid4())
-                
-                # Current timestamp
-                created_at = datetime.now()
-                
                 # Save as new worksheet, preserving original
-                with sqlite3.connect('worksheets.db') as conn:
-                    cursor = conn.cursor()
-                    cursor.execute('''
-                        INSERT INTO worksheets 
-                        (id, subject, topic, worksheet_content, created_at) 
-                        VALUES (?, ?, ?, ?, ?)
-                    ''', (
-                        new_worksheet_id, 
-                        subject, 
-                        f"Edited Version of {worksheet_id}", 
-                        json.dumps(edited_worksheet), 
-                        created_at
-                    ))
-                    conn.commit()
+                new_worksheet_id = worksheet_db.save_worksheet(
+                    subject=subject, 
+                    topic=f"Edited Version of {worksheet_id}", 
+                    worksheet_content=edited_worksheet
+                )
+                _cached_list_worksheets.clear()
                 
                 # Generate updated Word document
                 updated_doc = word(edited_worksheet, subject)
@@ -574,51 +1014,13 @@ def edit_worksheet(worksheet_id, subject, worksheet_content):
             except Exception as e:
                 st.error(f"Error saving worksheet: {e}")
                 logger.error(f"Worksheet save error: {e}")
-def modify_worksheets_table():
-    """
-    Ensure worksheet_content is stored as text with comprehensive logging
-    """
-    try:
-        with sqlite3.connect('worksheets.db') as conn:
-            cursor = conn.cursor()
-            
-            # More detailed column inspection
-            cursor.execute('''
-                PRAGMA table_info(worksheets)
-            ''')
-            columns = cursor.fetchall()
-            
-            # Detailed logging of existing columns
-            logger.info(f"Existing columns: {columns}")
-            
-            # Check if worksheet_content column exists and is of correct type
-            worksheet_content_column = [col for col in columns if col[1] == 'worksheet_content']
-            
-            if not worksheet_content_column:
-                # If column doesn't exist, add it with precise logging
-                logger.warning("worksheet_content column missing. Adding column.")
-                cursor.execute('''
-                    ALTER TABLE worksheets 
-                    ADD COLUMN worksheet_content TEXT
-                ''')
-                logger.info("worksheet_content column added successfully")
-            else:
-                logger.info("worksheet_content column already exists")
-            
-            conn.commit()
-    except Exception as e:
-        logger.error(f"Error modifying worksheets table: {e}")
-        st.error(f"Database modification error: {e}")
-# Call this method when initializing the database
-modify_worksheets_table()
 
 
 def database_viewer_page():
     st.header("📊 Worksheet Database Viewer")
     
-    # Database connection method
-    def connect_db():
-        return sqlite3.connect('worksheets.db')
+    # Reuse the shared connection; reads need no transaction
+    conn = worksheet_db.conn
     
     # Tabs for different views
     tab1, tab2, tab3 = st.tabs(["📋 All Worksheets", "📊 Database Stats", "🔍 Raw Database Query"])
@@ -627,17 +1029,16 @@ def database_viewer_page():
         st.subheader("All Stored Worksheets")
         
         # Retrieve all worksheets
-        with connect_db() as conn:
-            df = pd.read_sql_query("""
-                SELECT 
-                    id, 
-                    subject, 
-                    topic, 
-                    created_at, 
-                    length(worksheet_content) as content_length
-                FROM worksheets 
-                ORDER BY created_at DESC
-            """, conn)
+        df = pd.read_sql_query("""
+            SELECT 
+                id, 
+                subject, 
+                topic, 
+                created_at, 
+                content_length
+            FROM worksheets 
+            ORDER BY created_at DESC
+        """, conn)
         
         # Display as table
         st.dataframe(df, use_container_width=True)
@@ -646,10 +1047,9 @@ def database_viewer_page():
         if st.checkbox("Show Detailed Worksheet Contents"):
             worksheet_id = st.selectbox("Select Worksheet ID", df['id'].tolist())
             
-            with connect_db() as conn:
-                cursor = conn.cursor()
-                cursor.execute("SELECT * FROM worksheets WHERE id = ?", (worksheet_id,))
-                worksheet = cursor.fetchone()
+            cursor = conn.cursor()
+            cursor.execute("SELECT * FROM worksheets WHERE id = ?", (worksheet_id,))
+            worksheet = cursor.fetchone()
             
             if worksheet:
                 st.json({
@@ -664,17 +1064,16 @@ def database_viewer_page():
     with tab2:
         st.subheader("Database Statistics")
         
-        with connect_db() as conn:
-            # Total worksheets
-            total_worksheets = pd.read_sql_query("SELECT COUNT(*) as count FROM worksheets", conn).iloc[0,0]
+        # Total worksheets
+        total_worksheets = pd.read_sql_query("SELECT COUNT(*) as count FROM worksheets", conn).iloc[0,0]
             
-            # Worksheets by subject
-            subject_counts = pd.read_sql_query("""
-                SELECT subject, COUNT(*) as count 
-                FROM worksheets 
-                GROUP BY subject 
-                ORDER BY count DESC
-            """, conn)
+        # Worksheets by subject
+        subject_counts = pd.read_sql_query("""
+            SELECT subject, COUNT(*) as count 
+            FROM worksheets 
+            GROUP BY subject 
+            ORDER BY count DESC
+        """, conn)
         
         col1, col2 = st.columns(2)
         
@@ -695,8 +1094,10 @@ def database_viewer_page():
         
         if st.button("Execute Query"):
             try:
-                with connect_db() as conn:
-                    df = pd.read_sql_query(query, conn)
+                # Run user SQL on a throwaway read-only connection so a stray
+                # BEGIN or write can't leave the shared connection mid-transaction
+                with contextlib.closing(worksheet_db.connect_read_only()) as query_conn:
+                    df = pd.read_sql_query(query, query_conn)
                 st.dataframe(df, use_container_width=True)
             except Exception as e:
                 st.error(f"Error executing query: {e}")
@@ -707,38 +1108,51 @@ def worksheet_library_page():
     st.header("Worksheet Library")
     
     # Filter options
-    filter_subject = st.selectbox(
-        "Filter by Subject", 
-        ["All Subjects"] + [
-            "Mathematics", "English", "History", "Geography", 
-            "Biology", "Chemistry", "Physics", "Computer Science"
-        ]
-    )
+    filter_subject = st.selectbox("Filter by Subject", ("All Subjects", *SUBJECTS))
     
     # Retrieve worksheets
     if filter_subject == "All Subjects":
-        worksheets = worksheet_db.list_worksheets(limit=20)
+        worksheets = _cached_list_worksheets(None, 20)
     else:
-        worksheets = worksheet_db.list_worksheets(subject=filter_subject, limit=20)
+        worksheets = _cached_list_worksheets(filter_subject, 20)
+    
+    # Retrieve every listed worksheet's content in one query
+    contents = worksheet_db.get_worksheet_contents([worksheet[0] for worksheet in worksheets])
+    
+    # Build the Word documents in parallel before rendering; the worker threads
+    # only run python-docx, all Streamlit calls stay on this thread
+    # The listing can be up to 30s stale, so skip rows deleted since then
+    worksheets = [worksheet for worksheet in worksheets if worksheet[0] in contents]
+    
+    # Build the Word documents in parallel before rendering; the worker threads
+    # only run python-docx, all Streamlit calls stay on this thread
+    date = _header_date()
+    with ThreadPoolExecutor(max_workers=4) as executor:
+        doc_futures = {
+            worksheet_id: executor.submit(_word_bytes, subject, tuple(contents[worksheet_id]), date)
+            for worksheet_id, subject, _, _ in worksheets
+        }
     
     # Display worksheets
     for idx, worksheet in enumerate(worksheets):
         worksheet_id, subject, topic, created_at = worksheet
+        worksheet_content = contents[worksheet_id]
         
         with st.expander(f"{subject} - {topic} (Created: {created_at})"):
-            # Retrieve full worksheet details
-            full_worksheet = worksheet_db.get_worksheet_by_id(worksheet_id)
-            
             # Display worksheet content
-            for i, item in enumerate(full_worksheet['worksheet_content'], 1):
+            for i, item in enumerate(worksheet_content, 1):
                 st.write(f"{i}. {item}")
             
             # Columns for actions
             col1, col2 = st.columns(2)
             
             with col1:
-                # Generate Word document in memory
-                doc_bytes = word(full_worksheet['worksheet_content'], subject)
+                # Word document built above
+                try:
+                    doc_bytes = doc_futures[worksheet_id].result()
+                except Exception as e:
+                    st.error(f"Error generating Word document: {e}")
+                    doc_bytes = None
                 
                 if doc_bytes:
                     # Download button with unique key
@@ -756,30 +1170,8 @@ def worksheet_library_page():
                     edit_worksheet(
                         worksheet_id, 
                         subject, 
-                        full_worksheet['worksheet_content']
+                        worksheet_content
                     )
-# In the main() function, modify the download button:
-def main():
-    # ... existing code ...
-    if topic and create_button:
-        doc_download, worksheet_id = create_worksheet(subject_selection, topic)
-        
-        if doc_download:
-            bio = io.BytesIO()
-            doc = Document(doc_download)
-            doc.save(bio)
-
-            st.success(f"Worksheet created successfully! ID: {worksheet_id}")
-
-            st.download_button(
-                label="Click here to download",
-                data=bio.getvalue(),
-                file_name="Worksheet.docx",
-                mime="docx",
-                key="download_main_worksheet"  # Add a unique key
-            )
-        else:
-            st.error("Failed to create worksheet. Please try again.")
 # Main Application
 def main():
     st.set_page_config(
@@ -796,21 +1188,7 @@ def main():
     if page == "Create Worksheet":
         st.title("CASE - Worksheet Generator")
         
-        subject_selection = st.selectbox(
-            "Subject",
-            ["Select a Subject"] + ["Enter Your Own Subject"] + [
-                "Mathematics 🔢", "English 🇬🇧", "History 📜", "Geography 🌍", 
-                "Biology 🌿", "Chemistry 🧪", "Physics ⚙️", 
-                "Computer Science 💻", "Music 🎵", "Art 🎨", 
-                "Sports 🏃‍♂️", "Ethics 🤔", "Religion ⛪", 
-                "Politics 🗳️", "Economics 💹", "Philosophy 🤯", 
-                "Social Studies 👥", "Psychology 🧠", "Sociology 👩‍👩‍👧‍👦", 
-                "Foreign Language 🗣️", "Latin 🏛️", 
-                "Spanish 🇪🇸", "French 🇫🇷", "Italian 🇮🇹", 
-                "Russian 🇷🇺", "Chinese 🇨🇳", "Japanese 🇯🇵", 
-                "Korean 🇰🇷", "Arabic 🇸🇦", "Media Studies 📱"
-            ]
-        )
+        subject_selection = st.selectbox("Subject", ("Select a Subject", "Enter Your Own Subject", *SUBJECTS))
 
         if subject_selection != "Select a Subject":
             if subject_selection == "Enter Your Own Subject":
@@ -825,15 +1203,12 @@ def main():
                 doc_download, worksheet_id = create_worksheet(subject_selection, topic)
                 
                 if doc_download:
-                    bio = io.BytesIO()
-                    doc = Document(doc_download)
-                    doc.save(bio)
-
                     st.success(f"Worksheet created successfully! ID: {worksheet_id}")
 
+                    # word() already returns a serialized document in memory
                     st.download_button(
                         label="Click here to download",
-                        data=bio.getvalue(),
+                        data=doc_download.getvalue(),
                         file_name="Worksheet.docx",
                         mime="docx",
                         key="download_button"